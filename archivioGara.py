@@ -0,0 +1,298 @@
+import argparse
+import bisect
+import json
+import mmap
+import os
+import queue
+import threading
+
+# ==========================
+# Parametri dell'Archivio
+# ==========================
+
+checkpoint_interval = 256       # Righe tra due checkpoint dell'indice (limite di righe lette per query)
+initial_capacity = 65536        # Righe preallocate per colonna, raddoppiate quando servono
+
+# Colonne dell'archivio: nome e typecode (un file per colonna, <nome>.col)
+COLUMNS = (
+    ('t', 'd'),          # Secondi dalla partenza (tempo monotono di ricezione, non decrescente)
+    ('horse', 'H'),      # Indice del cavallo in meta.json['horses']
+    ('x', 'f'),          # Coordinate locali (metri)
+    ('y', 'f'),
+    ('distance', 'd'),   # Distanza cumulativa con i giri (metri)
+    ('lane', 'f'),       # metriCorsiaDelCavallo
+    ('speed', 'f'),      # km/h
+    ('lap', 'H'),        # Giri completati
+    ('prev', 'i'),       # Riga del fix precedente dello stesso cavallo (-1 per il primo)
+)
+
+ITEM_SIZES = {'d': 8, 'f': 4, 'H': 2, 'i': 4}
+
+# ==========================
+# Scrittura
+# ==========================
+
+class RaceRecorder:
+    """
+    Registra ogni fix elaborato in un archivio colonnare su disco.
+
+    record() accoda il fix e ritorna subito: la scrittura nelle colonne memory-mapped
+    avviene in un thread dedicato. Ogni checkpoint_interval righe viene salvato in meta.json
+    l'ultima riga di ogni cavallo, così le query non devono scorrere tutto l'archivio.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        self.rows = 0
+        self.capacity = 0
+        self.files = {}
+        self.maps = {}
+        self.views = {}
+        self.horse_ids = []         # Indice -> horse_id
+        self.horse_index = {}       # horse_id -> indice
+        self.last_row = []          # Indice del cavallo -> ultima riga scritta
+        self.checkpoints = []       # checkpoints[k]: last_row dopo (k + 1) * checkpoint_interval righe
+        self.summary = {}           # horse_id -> riepilogo aggiornato ad ogni fix
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        for name, typecode in COLUMNS:
+            self.files[name] = open(os.path.join(self.directory, f"{name}.col"), 'w+b')
+        self.resize(initial_capacity)
+        self.write_meta()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def record(self, t, horse_id, x, y, distance, lane, speed, lap):
+        self.queue.put((t, horse_id, x, y, distance, lane, speed, lap))
+
+    def close(self):
+        """Attende la scrittura dei fix in coda, riduce i file alle righe scritte e salva l'indice."""
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        self.write_meta()
+        for name, typecode in COLUMNS:
+            self.views[name].release()
+            self.maps[name].close()
+            self.files[name].truncate(self.rows * ITEM_SIZES[typecode])
+            self.files[name].close()
+
+    def resize(self, capacity):
+        for name, typecode in COLUMNS:
+            if name in self.views:
+                self.views[name].release()
+                self.maps[name].flush()
+                self.maps[name].close()
+            self.files[name].truncate(capacity * ITEM_SIZES[typecode])
+            self.maps[name] = mmap.mmap(self.files[name].fileno(), capacity * ITEM_SIZES[typecode])
+            self.views[name] = memoryview(self.maps[name]).cast(typecode)
+        self.capacity = capacity
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                self.append(*item)
+            except Exception as e:
+                print(f"Errore nella scrittura dell'archivio: {e}")
+
+    def append(self, t, horse_id, x, y, distance, lane, speed, lap):
+        if self.rows == self.capacity:
+            self.resize(self.capacity * 2)
+        horse = self.horse_index.get(horse_id)
+        if horse is None:
+            horse = len(self.horse_ids)
+            self.horse_index[horse_id] = horse
+            self.horse_ids.append(horse_id)
+            self.last_row.append(-1)
+            self.summary[horse_id] = {
+                'fixes': 0,
+                'first_t': t,
+                'start_distance': distance,
+                'max_speed': speed
+            }
+
+        row = self.rows
+        views = self.views
+        views['t'][row] = t
+        views['horse'][row] = horse
+        views['x'][row] = x
+        views['y'][row] = y
+        views['distance'][row] = distance
+        views['lane'][row] = lane
+        views['speed'][row] = speed
+        views['lap'][row] = lap
+        views['prev'][row] = self.last_row[horse]
+        self.last_row[horse] = row
+        self.rows += 1
+
+        summary = self.summary[horse_id]
+        summary['fixes'] += 1
+        summary['last_t'] = t
+        summary['end_distance'] = distance
+        summary['meters'] = distance - summary['start_distance']
+        summary['max_speed'] = max(summary['max_speed'], speed)
+        summary['laps'] = lap
+
+        if self.rows % checkpoint_interval == 0:
+            self.checkpoints.append(list(self.last_row))
+            self.write_meta()
+
+    def write_meta(self):
+        # Le righe fino a 'rows' sono già nelle colonne: flush prima di pubblicare l'indice
+        for name, typecode in COLUMNS:
+            self.maps[name].flush()
+        meta = {
+            'rows': self.rows,
+            'checkpoint_interval': checkpoint_interval,
+            'horses': self.horse_ids,
+            'checkpoints': self.checkpoints,
+            'summary': self.summary
+        }
+        temp_path = os.path.join(self.directory, 'meta.json.tmp')
+        with open(temp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(temp_path, os.path.join(self.directory, 'meta.json'))
+
+# ==========================
+# Lettura
+# ==========================
+
+class RaceArchive:
+    """
+    Legge un archivio scritto da RaceRecorder (anche durante la gara: sono visibili le righe
+    fino all'ultimo checkpoint). Le query usano la ricerca binaria sul tempo e i checkpoint,
+    leggendo al più checkpoint_interval righe oltre a quelle restituite.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json')) as f:
+            meta = json.load(f)
+        self.rows = meta['rows']
+        self.interval = meta['checkpoint_interval']
+        self.horse_ids = meta['horses']
+        self.checkpoints = meta['checkpoints']
+        self.race_summary = meta['summary']
+        self.maps = {}
+        self.columns = {}
+        for name, typecode in COLUMNS:
+            with open(os.path.join(directory, f"{name}.col"), 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if size == 0 or self.rows == 0:
+                    self.columns[name] = []
+                    continue
+                self.maps[name] = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            self.columns[name] = memoryview(self.maps[name]).cast(typecode)[:self.rows]
+
+    def close(self):
+        for name in self.maps:
+            self.columns[name].release()
+            self.maps[name].close()
+
+    def row_at(self, t):
+        """Ultima riga con tempo <= t (-1 se nessuna)."""
+        return bisect.bisect_right(self.columns['t'], t) - 1
+
+    def last_rows_at(self, row):
+        """Ultima riga di ogni cavallo fino a row compresa, partendo dal checkpoint precedente."""
+        checkpoint = (row + 1) // self.interval - 1
+        if checkpoint >= 0:
+            last_rows = list(self.checkpoints[checkpoint])
+            first = (checkpoint + 1) * self.interval
+        else:
+            last_rows = []
+            first = 0
+        last_rows += [-1] * (len(self.horse_ids) - len(last_rows))
+        horses = self.columns['horse']
+        for r in range(first, row + 1):
+            last_rows[horses[r]] = r
+        return last_rows
+
+    def fix(self, row):
+        columns = self.columns
+        return {
+            'horse_id': self.horse_ids[columns['horse'][row]],
+            't': columns['t'][row],
+            'x': columns['x'][row],
+            'y': columns['y'][row],
+            'distance': columns['distance'][row],
+            'lane': columns['lane'][row],
+            'speed': columns['speed'][row],
+            'lap': columns['lap'][row]
+        }
+
+    def standings_at(self, t):
+        """Classifica al tempo t: ultimo fix di ogni cavallo, ordinato per distanza decrescente."""
+        row = self.row_at(t)
+        if row < 0:
+            return []
+        fixes = [self.fix(r) for r in self.last_rows_at(row) if r >= 0]
+        return sorted(fixes, key=lambda fix: fix['distance'], reverse=True)
+
+    def trajectory(self, horse_id, t1, t2):
+        """Fix del cavallo con t1 <= t <= t2, in ordine di tempo (segue la catena 'prev')."""
+        if horse_id not in self.horse_ids:
+            return []
+        row = self.row_at(t2)
+        if row < 0:
+            return []
+        r = self.last_rows_at(row)[self.horse_ids.index(horse_id)]
+        fixes = []
+        times = self.columns['t']
+        prev = self.columns['prev']
+        while r >= 0 and times[r] >= t1:
+            fixes.append(self.fix(r))
+            r = prev[r]
+        fixes.reverse()
+        return fixes
+
+    def summary(self):
+        """Riepilogo della gara per cavallo, mantenuto dal RaceRecorder durante la scrittura."""
+        return {
+            'rows': self.rows,
+            'duration': self.columns['t'][self.rows - 1] if self.rows else 0.0,
+            'horses': self.race_summary
+        }
+
+# ==========================
+# Main
+# ==========================
+
+def main():
+    parser = argparse.ArgumentParser(description="Interrogazione dell'archivio di una gara")
+    parser.add_argument('directory', help="cartella della gara")
+    subparsers = parser.add_subparsers(dest='query', required=True)
+    subparsers.add_parser('summary', help="riepilogo della gara")
+    standings_parser = subparsers.add_parser('standings', help="classifica al tempo t")
+    standings_parser.add_argument('t', type=float)
+    trajectory_parser = subparsers.add_parser('trajectory', help="traiettoria di un cavallo tra t1 e t2")
+    trajectory_parser.add_argument('horse_id')
+    trajectory_parser.add_argument('t1', type=float)
+    trajectory_parser.add_argument('t2', type=float)
+    args = parser.parse_args()
+
+    archive = RaceArchive(args.directory)
+    if args.query == 'summary':
+        print(json.dumps(archive.summary(), indent=2))
+    elif args.query == 'standings':
+        for idx, fix in enumerate(archive.standings_at(args.t)):
+            print(f"{idx + 1}. Cavallo {fix['horse_id']}: {fix['distance']:.2f} m ({fix['lap']} giri), "
+                  f"Corsia: {fix['lane']:.2f}m, {fix['speed']:.2f} km/h, t={fix['t']:.2f}s")
+    else:
+        for fix in archive.trajectory(args.horse_id, args.t1, args.t2):
+            print(f"t={fix['t']:.2f}s x={fix['x']:.2f} y={fix['y']:.2f} distanza={fix['distance']:.2f} "
+                  f"corsia={fix['lane']:.2f} velocità={fix['speed']:.2f}")
+    archive.close()
+
+# Esegui il main
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
 import socket
+import struct
 import threading
+import time
 import pygame
 import re
 import random  # For generating random terrain elements
@@ -7,76 +9,242 @@ import random  # For generating random terrain elements
 # Settings for the UDP socket
 UDP_IP = "0.0.0.0"
 UDP_PORT = 4141
+MULTICAST_GROUP = None  # e.g. '239.41.41.41' to receive the leaderboard from the server's multicast group
 
 # Create the UDP socket
 sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # Several displays may listen on the same host
 sock.bind((UDP_IP, UDP_PORT))
+if MULTICAST_GROUP:
+    membership = struct.pack('4s4s', socket.inet_aton(MULTICAST_GROUP), socket.inet_aton('0.0.0.0'))
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
 
 # Shared data structure to store the standings
 standings = []
 standings_lock = threading.Lock()
 
+# Horse motion between leaderboard snapshots
+# Horse id -> {'prev': (t, meters_to_finish, y_coordinate) or None, 'last': (...), 'interval': seconds or None,
+#              'fix': the horse's own fields at its last update}
+horse_tracks = {}
+INTERPOLATION_DELAY = None   # Render delay in seconds; None = the horse's own update interval
+MAX_EXTRAPOLATION = 0.5      # How far past the last update to extrapolate, in update intervals
+
 def receive_packets():
     """Function in a separate thread to receive UDP packets."""
     while True:
-        data, addr = sock.recvfrom(1024)
+        data, addr = sock.recvfrom(65535)  # Leaderboards with many horses exceed 1 KB
+        received_at = time.monotonic()
         packet = data.decode('utf-8')
-        parse_packet(packet)
+        parse_packet(packet, received_at)
+
+# State of the delta-encoded stream (KEYFRAME/DELTA packets)
+stream_seq = None     # Sequence number of the last applied packet, None until the next KEYFRAME
+stream_order = []     # Horse ids in standings order
+stream_fields = {}    # Horse id -> [gap, meters_to_finish, y_coordinate, speed, time, last_split, projected_finish] as received
+DELTA_FIELD_CODES = {'g': 0, 'm': 1, 'y': 2, 'v': 3, 't': 4, 's': 5, 'f': 6}
 
-def parse_packet(packet):
+def parse_packet(packet, received_at=None):
     """Parse the received packet and update the standings."""
-    global standings
-    if not packet.startswith('CLASSIFICA'):
+    if received_at is None:
+        received_at = time.monotonic()
+    if packet.startswith('KEYFRAME') or packet.startswith('DELTA'):
+        new_standings = parse_stream_packet(packet)
+        if new_standings is None:
+            return
+    elif packet.startswith('CLASSIFICA'):
+        # Remove 'CLASSIFICA' from the packet
+        packet = packet[len('CLASSIFICA'):]
+        # Remove any leading commas
+        packet = packet.lstrip(',')
+        # Extract fields using regular expressions
+        fields = re.findall(r'\(([^)]+)\)', packet)
+        new_standings = []
+        for field in fields:
+            standing = parse_entry(field.split(','))
+            if standing is not None:
+                new_standings.append(standing)
+    else:
         return
-    # Remove 'CLASSIFICA' from the packet
-    packet = packet[len('CLASSIFICA'):]
-    # Remove any leading commas
-    packet = packet.lstrip(',')
-    # Extract fields using regular expressions
-    fields = re.findall(r'\(([^)]+)\)', packet)
-    new_standings = []
-    for field in fields:
-        parts = field.split(',')
-        if len(parts) != 6:
-            continue
-        horse_id_str, distance_or_name_str, meters_to_finish_str, y_coordinate_str, speed_str, time_str = parts
-        try:
-            horse_id = int(horse_id_str)
-        except ValueError:
-            continue
-        distance_or_name = distance_or_name_str.strip()
-        try:
-            meters_to_finish = float(meters_to_finish_str)
-        except ValueError:
+    update_standings(new_standings, received_at)
+
+def update_standings(new_standings, received_at):
+    """Store a new snapshot, computing each horse's layout only once per snapshot."""
+    global standings, horse_tracks
+    # Calculate computed_meters_to_finish for each horse based on cumulative gaps,
+    # starting from the last horse
+    if new_standings:
+        cumulative_meters_to_finish = new_standings[-1]['meters_to_finish']
+        new_standings[-1]['computed_meters_to_finish'] = cumulative_meters_to_finish
+        for i in range(len(new_standings) - 2, -1, -1):
+            distance = new_standings[i]['distance']
+            if distance is None:
+                distance = 0  # Assuming zero gap if missing
+            cumulative_meters_to_finish -= distance
+            new_standings[i]['computed_meters_to_finish'] = cumulative_meters_to_finish
+
+    # The server sends a leaderboard on every fix of any horse, and the gap-based position
+    # of every horse shifts whenever the last horse gets a fix. A horse's track only advances
+    # when the fields that only its own fix can change (its meters to finish, lane and speed)
+    # change, otherwise it would stop and go, and even step back, at every snapshot
+    new_tracks = {}
+    for horse in new_standings:
+        horse_id = horse['horse_id']
+        meters, y_coordinate = horse['computed_meters_to_finish'], horse['y_coordinate']
+        fix = (horse['meters_to_finish'], horse['y_coordinate'], horse['speed'])
+        previous = horse_tracks.get(horse_id)
+        if previous is None:
+            new_tracks[horse_id] = {'prev': None, 'last': (received_at, meters, y_coordinate), 'interval': None, 'fix': fix}
             continue
-        try:
-            y_coordinate = float(y_coordinate_str)
-        except ValueError:
+        last_time = previous['last'][0]
+        # No new fix for well over its own interval: the horse has really stopped
+        stopped = previous['interval'] is not None and received_at - last_time > (1 + MAX_EXTRAPOLATION) * previous['interval']
+        if fix == previous['fix'] and not stopped:
+            new_tracks[horse_id] = previous
             continue
-        # Handle 'distance' and 'last one'
-        if distance_or_name.lower() == 'last one':
-            distance = None
-        else:
-            try:
-                distance = float(distance_or_name)
-            except ValueError:
-                distance = None  # Invalid data
-        try:
-            speed = float(speed_str)
-        except ValueError:
-            speed = None  # Invalid data
-        new_standings.append({
-            'horse_id': horse_id,
-            'distance': distance,  # Gap to the next horse (behind)
-            'distance_or_name': distance_or_name,
-            'meters_to_finish': meters_to_finish,
-            'y_coordinate': y_coordinate,
-            'speed': speed,
-            'time': time_str
-        })
+        interval = min(2.0, max(0.02, received_at - last_time))
+        if previous['interval'] is not None:
+            interval = previous['interval'] + 0.3 * (interval - previous['interval'])
+        new_tracks[horse_id] = {'prev': previous['last'], 'last': (received_at, meters, y_coordinate), 'interval': interval, 'fix': fix}
+
     # Update the standings in a thread-safe manner
     with standings_lock:
         standings = new_standings
+        horse_tracks = new_tracks
+
+def interpolate_track(track, now):
+    """Horse (meters_to_finish, y_coordinate) at render time, between its last two updates.
+
+    Rendering runs one update interval of this horse behind now, so that motion
+    is interpolated rather than extrapolated while updates arrive on time.
+    """
+    t1, meters1, y1 = track['last']
+    if track['prev'] is None:
+        return meters1, y1
+    render_time = now - (track['interval'] if INTERPOLATION_DELAY is None else INTERPOLATION_DELAY)
+    t0, meters0, y0 = track['prev']
+    if t1 <= t0:
+        return meters1, y1
+    u = (render_time - t0) / (t1 - t0)
+    u = max(0.0, min(1.0 + MAX_EXTRAPOLATION, u))
+    return meters0 + u * (meters1 - meters0), y0 + u * (y1 - y0)
+
+def parse_stream_packet(packet):
+    """Apply a KEYFRAME or DELTA packet to the stream state.
+
+    Returns the new standings, or None if the packet could not be applied
+    (a sequence gap was detected and we are waiting for the next KEYFRAME).
+    """
+    global stream_seq, stream_order, stream_fields
+    header = packet.split(',', 2)
+    if len(header) < 2:
+        return None
+    kind = header[0]
+    try:
+        seq = int(header[1])
+    except ValueError:
+        return None
+    body = header[2] if len(header) > 2 else ''
+
+    if kind == 'KEYFRAME':
+        new_order = []
+        new_fields = {}
+        for field in re.findall(r'\(([^)]+)\)', body):
+            parts = field.split(',')
+            if len(parts) < 6:
+                continue
+            new_order.append(parts[0])
+            new_fields[parts[0]] = parts[1:]
+        stream_order = new_order
+        stream_fields = new_fields
+    else:
+        if stream_seq is None:
+            return None  # Still waiting for a KEYFRAME
+        if seq != stream_seq + 1:
+            print(f"Stream gap: expected {stream_seq + 1}, got {seq}. Waiting for next keyframe.")
+            stream_seq = None
+            return None
+        # Position swaps: [pos:id;pos:id]
+        for swaps in re.findall(r'\[([^\]]*)\]', body):
+            for swap in swaps.split(';'):
+                position_str, _, horse_id = swap.partition(':')
+                try:
+                    position = int(position_str) - 1
+                except ValueError:
+                    continue
+                if 0 <= position < len(stream_order):
+                    stream_order[position] = horse_id
+        # Changed fields: (id,code=value,...)
+        for field in re.findall(r'\(([^)]+)\)', body):
+            parts = field.split(',')
+            horse_fields = stream_fields.get(parts[0])
+            if horse_fields is None:
+                continue
+            for change in parts[1:]:
+                code, _, value = change.partition('=')
+                if code in DELTA_FIELD_CODES:
+                    horse_fields[DELTA_FIELD_CODES[code]] = value
+    stream_seq = seq
+
+    new_standings = []
+    for horse_id in stream_order:
+        standing = parse_entry([horse_id] + stream_fields[horse_id])
+        if standing is not None:
+            new_standings.append(standing)
+    return new_standings
+
+def parse_entry(parts):
+    """Convert the fields of a standings entry into a standing dict (None if invalid).
+
+    The first six fields are mandatory; newer servers append the last sectional
+    split and the projected finish time ('-' when not available yet).
+    """
+    if len(parts) < 6:
+        return None
+    horse_id_str, distance_or_name_str, meters_to_finish_str, y_coordinate_str, speed_str, time_str = parts[:6]
+    last_split_str = parts[6] if len(parts) > 6 else '-'
+    projected_finish_str = parts[7] if len(parts) > 7 else '-'
+    try:
+        horse_id = int(horse_id_str)
+    except ValueError:
+        return None
+    distance_or_name = distance_or_name_str.strip()
+    try:
+        meters_to_finish = float(meters_to_finish_str)
+    except ValueError:
+        return None
+    try:
+        y_coordinate = float(y_coordinate_str)
+    except ValueError:
+        return None
+    # Handle 'distance' and 'last one'
+    if distance_or_name.lower() == 'last one':
+        distance = None
+    else:
+        try:
+            distance = float(distance_or_name)
+        except ValueError:
+            distance = None  # Invalid data
+    try:
+        speed = float(speed_str)
+    except ValueError:
+        speed = None  # Invalid data
+    try:
+        last_split = float(last_split_str)
+    except ValueError:
+        last_split = None  # Not available yet
+    return {
+        'horse_id': horse_id,
+        'distance': distance,  # Gap to the next horse (behind)
+        'distance_or_name': distance_or_name,
+        'meters_to_finish': meters_to_finish,
+        'y_coordinate': y_coordinate,
+        'speed': speed,
+        'no_signal': speed_str.strip() == 'no signal',  # The server lost this horse's tracker
+        'time': time_str,
+        'last_split': last_split,
+        'projected_finish': None if projected_finish_str == '-' else projected_finish_str
+    }
 
 # Start the thread to receive UDP packets
 udp_thread = threading.Thread(target=receive_packets)
@@ -103,16 +271,12 @@ TRACK_END_X = WINDOW_WIDTH - 50
 TRACK_TOP_Y = 200
 TRACK_BOTTOM_Y = 400
 
-# Horse positions
-positions = {}
-alpha = 0.1  # Smoothing factor for positions
-
 position_size = 30        # Size of the position square
 position_padding = 10     # Space between position square and horse ID
 
 # Initialize terrain graphic elements
 terrain_elements = []
-terrain_element_speed = 5  # Speed of terrain elements
+terrain_element_speed = 150  # Speed of terrain elements (pixels per second)
 for i in range(20):
     x = random.randint(TRACK_START_X, TRACK_END_X)
     y = random.randint(TRACK_TOP_Y + 5, TRACK_BOTTOM_Y - 5)
@@ -124,6 +288,7 @@ Y_MAX = 20   # Top of the track in meters
 
 running = True
 clock = pygame.time.Clock()
+frame_time = 0.0  # Seconds since the previous frame
 
 while running:
     for event in pygame.event.get():
@@ -139,6 +304,7 @@ while running:
     # Get a copy of the current standings
     with standings_lock:
         current_standings = standings.copy()
+        current_tracks = horse_tracks
 
     # Draw the standings
     y_offset = 20
@@ -171,7 +337,8 @@ while running:
         pill_x = entry_rect.x + 10  # Positioned to the left in entry_rect
         pill_y = entry_rect.y + (entry_height - pill_height) // 2
         pill_rect = pygame.Rect(pill_x, pill_y, pill_width, pill_height)
-        pygame.draw.rect(screen, (200, 200, 200), pill_rect, border_radius=15)
+        pill_color = (120, 120, 120) if horse['no_signal'] else (200, 200, 200)
+        pygame.draw.rect(screen, pill_color, pill_rect, border_radius=15)
 
         # Write the horse ID inside the rounded rectangle
         horse_id_text = font.render(str(horse['horse_id']), True, (0, 0, 0))
@@ -206,7 +373,7 @@ while running:
 
     # Update and draw the terrain graphic elements
     for element in terrain_elements:
-        element['x'] -= terrain_element_speed
+        element['x'] -= terrain_element_speed * frame_time
         if element['x'] < TRACK_START_X:
             element['x'] = TRACK_END_X
             element['y'] = random.randint(TRACK_TOP_Y + 5, TRACK_BOTTOM_Y - 5)
@@ -217,26 +384,15 @@ while running:
     pygame.draw.line(screen, (0, 0, 0), (TRACK_START_X, TRACK_TOP_Y), (TRACK_END_X, TRACK_TOP_Y), 5)
     pygame.draw.line(screen, (0, 0, 0), (TRACK_START_X, TRACK_BOTTOM_Y), (TRACK_END_X, TRACK_BOTTOM_Y), 5)
 
-    # Calculate computed_meters_to_finish for each horse based on cumulative gaps
-    computed_meters_to_finish = {}
-    if current_standings:
-        # Start from the last horse
-        last_horse = current_standings[-1]
-        cumulative_meters_to_finish = last_horse['meters_to_finish']
-        computed_meters_to_finish[last_horse['horse_id']] = cumulative_meters_to_finish
-
-        # Process the horses from second last to first
-        for i in range(len(current_standings) - 2, -1, -1):
-            horse = current_standings[i]
-            horse_id = horse['horse_id']
-            distance = horse['distance']
-            if distance is None:
-                distance = 0  # Assuming zero gap if missing
-            cumulative_meters_to_finish -= distance
-            computed_meters_to_finish[horse_id] = cumulative_meters_to_finish
+    # Interpolate each horse between its last two updates at render time
+    now = time.monotonic()
+    interpolated = {}
+    for horse in current_standings:
+        interpolated[horse['horse_id']] = interpolate_track(current_tracks[horse['horse_id']], now)
 
+    if interpolated:
         # Get the min and max meters_to_finish for scaling
-        meters_to_finish_values = list(computed_meters_to_finish.values())
+        meters_to_finish_values = [meters for meters, y_coordinate in interpolated.values()]
         max_meters_to_finish = max(meters_to_finish_values)
         min_meters_to_finish = min(meters_to_finish_values)
     else:
@@ -257,27 +413,19 @@ while running:
 
     # Map horse positions
     if current_standings:
-        # Update positions with smoothing
+        positions = {}
         for horse in current_standings:
             horse_id = horse['horse_id']
-            meters_to_finish = computed_meters_to_finish[horse_id]
-            # Calculate target x position with margins
+            meters_to_finish, y_coordinate = interpolated[horse_id]
+            # Calculate x position with margins
             # Since meters_to_finish represents distance to finish line, horses with lower meters_to_finish are closer to the finish line (right side)
             # So we need to map meters_to_finish inversely
-            target_x = TRACK_START_X + SCALE * (max_meters_to_finish - meters_to_finish + MARGIN_DISTANCE)
-            y_coordinate = horse['y_coordinate']
+            screen_x = TRACK_START_X + SCALE * (max_meters_to_finish - meters_to_finish + MARGIN_DISTANCE)
             # Map y_coordinate to screen_y
             screen_y = TRACK_BOTTOM_Y - ((y_coordinate - Y_MIN) / (Y_MAX - Y_MIN)) * (TRACK_BOTTOM_Y - TRACK_TOP_Y)
             # Ensure screen_y is within limits
             screen_y = max(TRACK_TOP_Y, min(TRACK_BOTTOM_Y, screen_y))
-
-            if horse_id in positions:
-                prev_x = positions[horse_id]['x']
-                prev_y = positions[horse_id]['y']
-                positions[horse_id]['x'] = prev_x + alpha * (target_x - prev_x)
-                positions[horse_id]['y'] = prev_y + alpha * (screen_y - prev_y)
-            else:
-                positions[horse_id] = {'x': target_x, 'y': screen_y}  # First time, set directly
+            positions[horse_id] = {'x': screen_x, 'y': screen_y}
 
         # Draw the horses on the track
         for horse in current_standings:
@@ -286,7 +434,8 @@ while running:
             horse_x = horse_pos['x']
             horse_y = horse_pos['y']
             # Draw the horse as a circle
-            pygame.draw.circle(screen, (0, 0, 255), (int(horse_x), int(horse_y)), 15)
+            horse_color = (110, 110, 110) if horse['no_signal'] else (0, 0, 255)
+            pygame.draw.circle(screen, horse_color, (int(horse_x), int(horse_y)), 15)
             # Write the horse ID at the center of the circle
             horse_text = font.render(str(horse_id), True, (255, 255, 255))
             text_rect = horse_text.get_rect(center=(int(horse_x), int(horse_y)))
@@ -294,7 +443,7 @@ while running:
 
         # Draw the "AL TRAGUARDO" box for the first horse
         first_horse = current_standings[0]
-        meters_to_finish_first_horse = int(computed_meters_to_finish[first_horse['horse_id']])
+        meters_to_finish_first_horse = int(first_horse['computed_meters_to_finish'])
 
         # Define box dimensions
         box_width = 203
@@ -375,12 +524,10 @@ while running:
                 # traguardo_text = font.render("TRAGUARDO", True, (255, 0, 0))
                 # traguardo_rect = traguardo_text.get_rect(center=(finish_line_x, TRACK_TOP_Y - 20))
                 # screen.blit(traguardo_text, traguardo_rect)
-    else:
-        positions = {}
 
     # Update the screen
     pygame.display.flip()
     # Limit the frame rate
-    clock.tick(30)
+    frame_time = clock.tick(30) / 1000.0
 
 pygame.quit()
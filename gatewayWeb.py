@@ -0,0 +1,377 @@
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import random
+import socket
+import struct
+import sys
+import time
+
+import pierpaolo
+
+# ==========================
+# Parametri del Gateway
+# ==========================
+
+PUBLISHER_HOST = '127.0.0.1'    # Host su cui gira pierpaolo.py
+GATEWAY_UDP_PORT = 4143         # Porta UDP su cui il gateway riceve la classifica binaria
+HTTP_HOST = '0.0.0.0'           # Interfaccia per i browser (localhost/LAN)
+HTTP_PORT = 8080                # Porta HTTP: /events (Server-Sent Events) e /ws (WebSocket)
+CLIENT_WRITE_HIGH_WATER = 2048  # Byte in attesa nel transport (circa un frame) oltre i quali drain() si blocca
+CLIENT_SOCKET_BUFFER = 4096     # SO_SNDBUF per client: limita i dati vecchi già accodati nel kernel
+CLIENT_NOTSENT_LOWAT = 1        # Byte non ancora trasmessi oltre i quali il socket non è scrivibile (Linux)
+SLOW_CLIENT_RATE = 5000         # Banda dei client lenti nel test di carico (byte/s, circa due frame al secondo)
+RENEW_INTERVAL = pierpaolo.subscriber_ttl / 3  # Ogni quanto rinnovare la sottoscrizione (secondi)
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+# Non tutte le versioni di Python espongono la costante
+TCP_NOTSENT_LOWAT = getattr(socket, 'TCP_NOTSENT_LOWAT', 25 if sys.platform.startswith('linux') else None)
+
+# ==========================
+# Funzioni utili
+# ==========================
+
+def leaderboard_to_json(seq, rows, leader_x, leader_y, freshest_age, stalest_age):
+    """Serializza una classifica decodificata in JSON (una sola volta per aggiornamento)."""
+    message = {
+        'seq': seq,
+        'ts': time.time(),
+        'leader': {'x': round(leader_x, 2), 'y': round(leader_y, 2)},
+        'fix_age_ms': {'freshest': round(freshest_age * 1000), 'stalest': round(stalest_age * 1000)},
+        'standings': [
+            {
+                'horse_id': horse_id,
+                'gap': None if gap is None else round(gap, 2),
+                'meters_to_finish': meters_to_finish,
+                'lane': round(lane, 2),
+                'speed': None if speed is None else round(speed, 2),
+                'no_signal': speed is None,
+                'elapsed': round(elapsed, 1),
+                'last_split': None if last_split is None else round(last_split, 2),
+                'projected_finish': None if projected_finish is None else round(projected_finish, 1)
+            }
+            for horse_id, gap, meters_to_finish, lane, speed, elapsed, last_split, projected_finish in rows
+        ]
+    }
+    return json.dumps(message, separators=(',', ':')).encode('utf-8')
+
+def websocket_frame(payload, opcode=0x1):
+    """Costruisce un frame WebSocket non mascherato (server -> client)."""
+    header = bytearray([0x80 | opcode])
+    length = len(payload)
+    if length < 126:
+        header.append(length)
+    elif length < 65536:
+        header.append(126)
+        header += struct.pack('!H', length)
+    else:
+        header.append(127)
+        header += struct.pack('!Q', length)
+    return bytes(header) + payload
+
+async def read_websocket_frame(reader):
+    """Legge un frame WebSocket (mascherato o no). Restituisce (opcode, payload)."""
+    first, second = await reader.readexactly(2)
+    length = second & 0x7F
+    if length == 126:
+        length = struct.unpack('!H', await reader.readexactly(2))[0]
+    elif length == 127:
+        length = struct.unpack('!Q', await reader.readexactly(8))[0]
+    mask = await reader.readexactly(4) if second & 0x80 else None
+    payload = await reader.readexactly(length)
+    if mask:
+        payload = bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+    return first & 0x0F, payload
+
+# ==========================
+# Gateway
+# ==========================
+
+class Client:
+    """Un browser collegato: coda limitata di frame già serializzati e task di scrittura."""
+
+    def __init__(self, kind, writer):
+        self.kind = kind            # 'sse' oppure 'ws'
+        self.writer = writer
+        # Buffer di circa un frame: drain() si blocca subito e i frame vecchi vengono sostituiti
+        # nello slot del client invece di restare nel transport o nel socket
+        writer.transport.set_write_buffer_limits(high=CLIENT_WRITE_HIGH_WATER)
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, CLIENT_SOCKET_BUFFER)
+            if TCP_NOTSENT_LOWAT is not None:
+                try:
+                    sock.setsockopt(socket.IPPROTO_TCP, TCP_NOTSENT_LOWAT, CLIENT_NOTSENT_LOWAT)
+                except OSError:
+                    pass
+        self.pending = None         # Ultimo frame non ancora inviato (uno solo: è una classifica live)
+        self.ready = asyncio.Event()
+        self.dropped = 0
+
+    def offer(self, frame):
+        # Client lento: il frame non ancora inviato è sostituito dal più recente
+        if self.pending is not None:
+            self.dropped += 1
+        self.pending = frame
+        self.ready.set()
+
+    async def run(self):
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            frame, self.pending = self.pending, None
+            self.writer.write(frame)
+            await self.writer.drain()
+
+class Gateway:
+    """
+    Riceve la classifica una sola volta dal Publisher di pierpaolo.py (formato binario)
+    e la distribuisce a molti browser via Server-Sent Events o WebSocket.
+    """
+
+    def __init__(self):
+        self.clients = set()
+        self.last_frames = None     # Ultimo aggiornamento, inviato subito ai nuovi client
+        self.updates = 0
+        self.frames_sent = 0
+
+    def broadcast(self, payload):
+        # Serializzazione unica per aggiornamento: lo stesso frame va a tutti i client dello stesso tipo
+        frames = {
+            'sse': b'data: ' + payload + b'\n\n',
+            'ws': websocket_frame(payload)
+        }
+        self.last_frames = frames
+        self.updates += 1
+        for client in self.clients:
+            client.offer(frames[client.kind])
+        self.frames_sent += len(self.clients)
+
+    async def handle_connection(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            writer.close()
+            return
+
+        path = request_line[1] if len(request_line) > 1 else ''
+        if path == '/ws' and headers.get('upgrade', '').lower() == 'websocket' and 'sec-websocket-key' in headers:
+            accept = base64.b64encode(hashlib.sha1((headers['sec-websocket-key'] + WEBSOCKET_GUID).encode()).digest()).decode()
+            writer.write(
+                "HTTP/1.1 101 Switching Protocols\r\n"
+                "Upgrade: websocket\r\n"
+                "Connection: Upgrade\r\n"
+                f"Sec-WebSocket-Accept: {accept}\r\n\r\n".encode('latin-1')
+            )
+            await self.serve_client(Client('ws', writer), self.watch_websocket(reader, writer))
+        elif path == '/events':
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/event-stream\r\n"
+                b"Cache-Control: no-cache\r\n"
+                b"Access-Control-Allow-Origin: *\r\n"
+                b"Connection: keep-alive\r\n\r\n"
+            )
+            await self.serve_client(Client('sse', writer), reader.read())
+        else:
+            writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            writer.close()
+
+    async def watch_websocket(self, reader, writer):
+        """Legge i frame del browser: risponde ai ping e termina alla chiusura."""
+        while True:
+            opcode, payload = await read_websocket_frame(reader)
+            if opcode == 0x8:
+                writer.write(websocket_frame(payload[:2], opcode=0x8))
+                return
+            if opcode == 0x9:
+                writer.write(websocket_frame(payload, opcode=0xA))
+
+    async def serve_client(self, client, closed):
+        """Registra il client finché la connessione non si chiude (closed) o la scrittura fallisce."""
+        if self.last_frames is not None:
+            client.offer(self.last_frames[client.kind])
+        self.clients.add(client)
+        sender = asyncio.ensure_future(client.run())
+        watcher = asyncio.ensure_future(closed)
+        try:
+            await asyncio.wait([sender, watcher], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            self.clients.discard(client)
+            sender.cancel()
+            watcher.cancel()
+            await asyncio.gather(sender, watcher, return_exceptions=True)
+            client.writer.close()
+
+class LeaderboardProtocol(asyncio.DatagramProtocol):
+    """Riceve i pacchetti binari della classifica dal Publisher."""
+
+    def __init__(self, gateway):
+        self.gateway = gateway
+
+    def datagram_received(self, data, addr):
+        if not data.startswith(pierpaolo.binary_magic):
+            return  # Es. la risposta SUBOK del Publisher
+        try:
+            seq, rows, leader_x, leader_y, freshest_age, stalest_age = pierpaolo.decode_binary_leaderboard(data)
+        except (ValueError, struct.error, IndexError) as e:
+            print(f"Pacchetto binario non valido da {addr}: {e}")
+            return
+        self.gateway.broadcast(leaderboard_to_json(seq, rows, leader_x, leader_y, freshest_age, stalest_age))
+
+async def keep_subscribed(transport, publisher_address, udp_port):
+    """Rinnova periodicamente la sottoscrizione binaria presso il Publisher."""
+    while True:
+        transport.sendto(f"SUB,{udp_port},binary".encode('utf-8'), publisher_address)
+        await asyncio.sleep(RENEW_INTERVAL)
+
+# ==========================
+# Test di carico
+# ==========================
+
+async def receive_link(sock, reader, rate):
+    """Passa al reader i byte ricevuti dalla socket, al più rate byte al secondo se indicato."""
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            data = await loop.sock_recv(sock, 256 if rate else 65536)
+            if not data:
+                break
+            reader.feed_data(data)
+            if rate:
+                await asyncio.sleep(len(data) / rate)
+    except (ConnectionError, OSError):
+        pass
+    finally:
+        reader.feed_eof()
+
+async def load_test_client(kind, host, port, stats, slow):
+    loop = asyncio.get_running_loop()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if slow:
+        # Un client lento simula un link Wi-Fi congestionato: legge dalla socket a banda limitata
+        # e riceve i frame appena arrivano, come un browser con una connessione lenta
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024)
+    sock.setblocking(False)
+    await loop.sock_connect(sock, (host, port))
+    reader = asyncio.StreamReader(limit=2 ** 16)
+    link = asyncio.ensure_future(receive_link(sock, reader, SLOW_CLIENT_RATE if slow else None))
+    if kind == 'ws':
+        key = base64.b64encode(random.randbytes(16)).decode()
+        await loop.sock_sendall(sock, f"GET /ws HTTP/1.1\r\nHost: {host}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n".encode())
+    else:
+        await loop.sock_sendall(sock, f"GET /events HTTP/1.1\r\nHost: {host}\r\n\r\n".encode())
+    try:
+        while (await reader.readline()).strip():
+            pass  # Salta le intestazioni della risposta
+        while True:
+            if kind == 'ws':
+                _, payload = await read_websocket_frame(reader)
+            else:
+                payload = (await reader.readline()).strip()[len(b'data: '):]
+                await reader.readline()
+                if not payload:
+                    break
+            stats['latencies'].append(time.time() - json.loads(payload)['ts'])
+            stats['received'] += 1
+    except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+        pass
+    finally:
+        link.cancel()
+        await asyncio.gather(link, return_exceptions=True)
+        sock.close()
+
+async def load_test(num_clients, duration, rate):
+    """
+    Avvia il gateway su una porta libera, collega num_clients client simulati
+    (metà SSE e metà WebSocket, uno su dieci lento) e pubblica classifiche sintetiche.
+    """
+    gateway = Gateway()
+    server = await asyncio.start_server(gateway.handle_connection, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    stats = {'received': 0, 'latencies': []}
+    slow_stats = {'received': 0, 'latencies': []}
+    clients = [
+        asyncio.ensure_future(load_test_client('ws' if i % 2 else 'sse', '127.0.0.1', port, slow_stats if i % 10 == 0 else stats, slow=(i % 10 == 0)))
+        for i in range(num_clients)
+    ]
+    while len(gateway.clients) < num_clients:
+        await asyncio.sleep(0.05)
+
+    # Classifica sintetica con id lunghi per avere frame di dimensione realistica
+    rows = [(f"{i + 1:02d}-{'X' * 40}", 1.5, 1200 - i, 4.0, 55.0, 30.0, 13.2, 101.4) for i in range(12)]
+    start = time.monotonic()
+    serialize_time = 0.0
+    seq = 0
+    while time.monotonic() - start < duration:
+        seq += 1
+        t0 = time.perf_counter()
+        gateway.broadcast(leaderboard_to_json(seq, rows, 10.0, 5.0, 0.05, 0.3))
+        serialize_time += time.perf_counter() - t0
+        await asyncio.sleep(1.0 / rate)
+    await asyncio.sleep(0.5)
+
+    dropped = sum(client.dropped for client in gateway.clients)
+    for client in clients:
+        client.cancel()
+    await asyncio.gather(*clients, return_exceptions=True)
+    # Attende che il gateway chiuda le connessioni lato server
+    while gateway.clients:
+        await asyncio.sleep(0.05)
+    server.close()
+    await server.wait_closed()
+
+    print(f"Client: {num_clients}, aggiornamenti: {gateway.updates}, frame accodati: {gateway.frames_sent}")
+    print(f"Serializzazione + fan-out medio per aggiornamento: {serialize_time / max(gateway.updates, 1) * 1000:.2f} ms")
+    print(f"Frame scartati per client lenti: {dropped}")
+    for label, client_stats in (('Client normali', stats), ('Client lenti', slow_stats)):
+        latencies = sorted(client_stats['latencies']) or [0.0]
+        print(f"{label}: {client_stats['received']} frame ricevuti, latenza p50: {latencies[len(latencies) // 2] * 1000:.1f} ms, "
+              f"p95: {latencies[int(len(latencies) * 0.95)] * 1000:.1f} ms, max: {latencies[-1] * 1000:.1f} ms")
+
+# ==========================
+# Main
+# ==========================
+
+async def serve(publisher_host, udp_port, http_host, http_port):
+    gateway = Gateway()
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(lambda: LeaderboardProtocol(gateway), local_addr=('0.0.0.0', udp_port))
+    asyncio.ensure_future(keep_subscribed(transport, (publisher_host, pierpaolo.control_port), udp_port))
+    server = await asyncio.start_server(gateway.handle_connection, http_host, http_port)
+    print(f"Gateway in ascolto su http://{http_host}:{http_port} (/events, /ws)")
+    async with server:
+        await server.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description="Gateway WebSocket/SSE per la classifica")
+    parser.add_argument('--publisher', default=PUBLISHER_HOST, help="host di pierpaolo.py")
+    parser.add_argument('--udp-port', type=int, default=GATEWAY_UDP_PORT)
+    parser.add_argument('--http-host', default=HTTP_HOST)
+    parser.add_argument('--http-port', type=int, default=HTTP_PORT)
+    parser.add_argument('--load-test', type=int, metavar='CLIENTS', help="esegue il test di carico con CLIENTS client simulati")
+    parser.add_argument('--duration', type=float, default=10.0, help="durata del test di carico (secondi)")
+    parser.add_argument('--rate', type=float, default=10.0, help="aggiornamenti al secondo nel test di carico")
+    args = parser.parse_args()
+
+    try:
+        if args.load_test:
+            asyncio.run(load_test(args.load_test, args.duration, args.rate))
+        else:
+            asyncio.run(serve(args.publisher, args.udp_port, args.http_host, args.http_port))
+    except KeyboardInterrupt:
+        print("Gateway terminato.")
+
+# Esegui il main
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,13 @@
 import math
+import os
 import socket
+import struct
+import sys
 import threading
 import time
+from collections import deque
+
+from archivioGara import RaceRecorder
 
 # ==========================
 # Parametri dell'Ippodromo
@@ -22,6 +28,59 @@ mRetBeforeP0 = 180              # Metri del rettilineo prima del punto zero (arr
 mLarghezza = 20                 # Metri di larghezza del circuito Ippodromo
 
 total_race_meters = 1600        # Lunghezza della gara in metri
+sectional_interval = 200        # Metri tra due marker dei tempi parziali
+pace_time_constant = 3.0        # Costante di tempo (s) della media del passo usata per il tempo finale previsto
+
+# ==========================
+# Parametri del registro dei cavalli
+# ==========================
+
+roster = None                   # Es. {'1', '2', '3'}: se impostato sono accettati solo questi horse_id
+max_horses = 24                 # Numero massimo di cavalli in classifica
+# Dimensione dei pacchetti: ogni voce testuale occupa fino a ~55 byte (id di 2 caratteri), quindi
+# 24 cavalli fanno ~1,3 KB, entro i 1472 byte di un datagramma UDP su Ethernet senza frammentazione.
+# I ricevitori devono leggere con un buffer di almeno 64 KB (classificaGrafica.py usa 65535).
+horse_ttl = 5.0                 # Secondi senza fix dopo i quali un cavallo è segnato "no signal"
+horse_sweep_interval = 0.5      # Ogni quanti secondi controllare i cavalli senza segnale
+
+race_archive_dir = 'gare'       # Cartella dell'archivio colonnare delle gare (None per disattivarlo)
+
+# ==========================
+# Parametri di trasmissione della classifica
+# ==========================
+
+output_mode = 'full'            # 'full': CLASSIFICA completa ad ogni aggiornamento, 'delta': KEYFRAME periodici + DELTA
+keyframe_interval_ms = 1000     # Intervallo tra due KEYFRAME in modalità 'delta' (millisecondi)
+
+# Codici dei campi nei pacchetti DELTA, nello stesso ordine dei campi di una voce della classifica
+delta_field_codes = ('g', 'm', 'y', 'v', 't', 's', 'f')  # gap, metri al traguardo, corsia, velocità, tempo, ultimo parziale, finale previsto
+
+default_output_address = ('0.0.0.0', 4141)  # Destinatario fisso della classifica testuale
+multicast_group = None          # Es. '239.41.41.41': se impostato la classifica testuale è inviata anche al gruppo multicast
+multicast_port = 4141           # Porta del gruppo multicast
+multicast_ttl = 1               # TTL dei pacchetti multicast (1 = solo rete locale)
+control_port = 4142             # Porta UDP dei messaggi di controllo (SUB/ACK/UNSUB) dei sottoscrittori
+subscriber_ttl = 10.0           # Secondi senza SUB/ACK dopo i quali un sottoscrittore scade
+
+# Formato binario della classifica (big endian):
+# intestazione: magic, sequenza, numero di cavalli, x e y del primo cavallo, età del fix più recente e più vecchio (s)
+# voce: lunghezza id, id, gap (NaN per l'ultimo), metri al traguardo, corsia, velocità, tempo trascorso (s),
+#       ultimo parziale (s) e tempo finale previsto (s), NaN se non ancora disponibili
+binary_magic = b'CLB3'
+binary_header = struct.Struct('!4sIHffff')
+binary_entry = struct.Struct('!fifffff')
+
+# ==========================
+# Parametri di misura della latenza
+# ==========================
+
+tracker_timestamp_field = 8     # Indice del campo con il timestamp del tracker nel pacchetto GPS (epoch in s o ms)
+tracker_timestamp_tolerance = 5.0  # Scarto massimo (s) dalla ricezione oltre cui il timestamp del tracker è ignorato
+latency_window = 1000           # Numero di aggiornamenti considerati nel report di latenza
+latency_report_interval = 10.0  # Ogni quanti secondi stampare il report di latenza durante la gara
+
+# Timestamp di ricezione del kernel (Linux): non tutte le versioni di Python espongono la costante
+SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35 if sys.platform.startswith('linux') else None)
 
 # ==========================
 # Funzioni utili
@@ -72,6 +131,26 @@ def convert_local_to_gps(x, y, ZeroLati, ZeroLong, mxmLati, mxmLong, vCosRotIpp,
 
     return CavLati, CavLong
 
+# Formatta un tempo di gara in secondi come "1:42.3" (o "42.3" sotto il minuto)
+def format_race_time(seconds):
+    tenths = round(seconds * 10)  # Arrotonda prima di separare minuti e secondi
+    minutes, tenths = divmod(tenths, 600)
+    if minutes:
+        return f"{minutes}:{tenths // 10:02d}.{tenths % 10}"
+    return f"{tenths // 10}.{tenths % 10}"
+
+# Converte il timestamp del tracker in secondi epoch (accetta secondi o millisecondi)
+def parse_tracker_timestamp(value):
+    try:
+        timestamp = float(value)
+    except ValueError:
+        return None
+    if timestamp <= 0:
+        return None
+    if timestamp > 1e11:
+        timestamp /= 1000.0  # Millisecondi
+    return timestamp
+
 # Calcola la distanza punto-segmento e la proiezione sul segmento
 def point_to_segment_distance(x, y, segment):
     x1, y1 = segment['x1'], segment['y1']
@@ -200,6 +279,249 @@ def create_segment(index, x1, y1, x2, y2, cumulative_distance):
         'cumulative_distance': cumulative_distance - math.hypot(x2 - x1, y2 - y1)  # Distanza cumulativa fino all'inizio di questo segmento
     }
 
+# ==========================
+# Pubblicazione della classifica
+# ==========================
+
+def encode_binary_leaderboard(seq, rows, leader_x, leader_y, freshest_age, stalest_age):
+    """
+    Serializza la classifica nel formato binario (vedi binary_header e binary_entry).
+    rows: lista di (horse_id, gap o None, metri al traguardo, corsia, velocità, tempo trascorso,
+    ultimo parziale o None, tempo finale previsto o None).
+    """
+    chunks = [binary_header.pack(binary_magic, seq & 0xFFFFFFFF, len(rows), leader_x, leader_y, freshest_age, stalest_age)]
+    for horse_id, gap, meters_to_finish, lane, speed, elapsed, last_split, projected_finish in rows:
+        horse_id_bytes = horse_id.encode('utf-8')[:255]
+        chunks.append(bytes([len(horse_id_bytes)]))
+        chunks.append(horse_id_bytes)
+        chunks.append(binary_entry.pack(
+            math.nan if gap is None else gap, meters_to_finish, lane, math.nan if speed is None else speed, elapsed,
+            math.nan if last_split is None else last_split,
+            math.nan if projected_finish is None else projected_finish
+        ))
+    return b''.join(chunks)
+
+def decode_binary_leaderboard(data):
+    """
+    Decodifica un pacchetto binario della classifica.
+    Restituisce (seq, rows, leader_x, leader_y, freshest_age, stalest_age)
+    con rows nello stesso formato di encode_binary_leaderboard.
+    """
+    magic, seq, count, leader_x, leader_y, freshest_age, stalest_age = binary_header.unpack_from(data, 0)
+    if magic != binary_magic:
+        raise ValueError("Pacchetto binario non valido")
+    offset = binary_header.size
+    rows = []
+    for _ in range(count):
+        length = data[offset]
+        horse_id = data[offset + 1:offset + 1 + length].decode('utf-8')
+        offset += 1 + length
+        gap, meters_to_finish, lane, speed, elapsed, last_split, projected_finish = binary_entry.unpack_from(data, offset)
+        offset += binary_entry.size
+        rows.append((
+            horse_id, None if math.isnan(gap) else gap, meters_to_finish, lane, None if math.isnan(speed) else speed, elapsed,
+            None if math.isnan(last_split) else last_split,
+            None if math.isnan(projected_finish) else projected_finish
+        ))
+    return seq, rows, leader_x, leader_y, freshest_age, stalest_age
+
+class LatencyStats:
+    """
+    Scompone la latenza di ogni aggiornamento della classifica:
+    - radio/rete: dal timestamp del tracker alla ricezione nel kernel (richiede orologi sincronizzati)
+    - coda: dalla ricezione nel kernel alla lettura dalla socket
+    - elaborazione: dalla lettura dalla socket all'invio della classifica
+    """
+
+    components = ('radio/rete', 'coda', 'elaborazione', 'totale')
+
+    def __init__(self):
+        self.samples = {component: deque(maxlen=latency_window) for component in self.components}
+
+    def add(self, receipt, tracker_time, emit_mono):
+        network = None
+        queue = None
+        if receipt['kernel'] is not None:
+            queue = receipt['wall'] - receipt['kernel']
+            if tracker_time is not None:
+                network = receipt['kernel'] - tracker_time
+        elif tracker_time is not None:
+            network = receipt['wall'] - tracker_time
+        processing = emit_mono - receipt['mono']
+        if network is not None:
+            self.samples['radio/rete'].append(network)
+        if queue is not None:
+            self.samples['coda'].append(queue)
+        self.samples['elaborazione'].append(processing)
+        self.samples['totale'].append(processing + (queue or 0.0) + (network or 0.0))
+
+    def report(self):
+        print("\n[LATENZA] ms (ultimi aggiornamenti)      n      p50      p95      max")
+        for component in self.components:
+            values = sorted(self.samples[component])
+            if not values:
+                print(f"  {component:<32}     0        -        -        -")
+                continue
+            p50 = values[len(values) // 2] * 1000
+            p95 = values[int(len(values) * 0.95)] * 1000
+            print(f"  {component:<32} {len(values):5d} {p50:8.1f} {p95:8.1f} {values[-1] * 1000:8.1f}")
+        print("")
+
+class Publisher:
+    """
+    Registro dei sottoscrittori della classifica.
+
+    Oltre ai destinatari fissi (default_output_address ed eventuale gruppo multicast), i client
+    si registrano inviando alla porta di controllo:
+        SUB,<porta>[,<text|binary>[,<max aggiornamenti al secondo>]]
+        ACK,<porta>      (rinnova la sottoscrizione)
+        UNSUB,<porta>
+    I sottoscrittori che non rinnovano entro subscriber_ttl secondi vengono rimossi.
+    Ogni formato viene serializzato una sola volta per aggiornamento e riusato per tutti.
+    """
+
+    def __init__(self, control_ip, control_port):
+        self.control_ip = control_ip
+        self.control_port = control_port
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.control_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.subscribers = {}  # (ip, porta) -> dizionario del sottoscrittore
+        self.lock = threading.Lock()
+        self.last_sweep = time.monotonic()
+
+        self.add_subscriber(default_output_address, 'text', 0, static=True)
+        if multicast_group:
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, multicast_ttl)
+            self.add_subscriber((multicast_group, multicast_port), 'text', 0, static=True)
+
+    def add_subscriber(self, address, fmt, max_rate, static=False):
+        now = time.monotonic()
+        with self.lock:
+            subscriber = self.subscribers.get(address)
+            if subscriber is None:
+                print(f"[INFO] Nuovo sottoscrittore {address[0]}:{address[1]} ({fmt}, max {max_rate or '-'} agg/s)")
+                subscriber = {
+                    'address': address,
+                    'last_sent': None,
+                    'needs_keyframe': True,
+                    'static': static
+                }
+                self.subscribers[address] = subscriber
+            subscriber['format'] = fmt
+            subscriber['min_interval'] = 1.0 / max_rate if max_rate > 0 else 0.0
+            subscriber['last_seen'] = now
+
+    def start(self):
+        try:
+            self.control_sock.bind((self.control_ip, self.control_port))
+            print(f"Controllo sottoscrittori in ascolto su {self.control_ip}:{self.control_port}")
+        except Exception as e:
+            print(f"Errore nel bind della socket di controllo: {e}")
+            return
+        thread = threading.Thread(target=self.listen_control)
+        thread.daemon = True
+        thread.start()
+
+    def listen_control(self):
+        while True:
+            try:
+                data, addr = self.control_sock.recvfrom(1024)
+                self.process_control(data.decode('utf-8').strip(), addr)
+            except Exception as e:
+                print(f"Errore nel messaggio di controllo: {e}")
+
+    def process_control(self, message, addr):
+        parts = [part.strip() for part in message.split(',')]
+        command = parts[0].upper()
+        if len(parts) < 2:
+            print(f"Messaggio di controllo incompleto da {addr}: {message}")
+            return
+        port = int(parts[1])
+        if not 1 <= port <= 65535:
+            print(f"Porta non valida da {addr}: {message}")
+            return
+        address = (addr[0], port)
+        if command == 'SUB':
+            fmt = parts[2].lower() if len(parts) > 2 and parts[2] else 'text'
+            if fmt not in ('text', 'binary'):
+                print(f"Formato sconosciuto da {addr}: {fmt}")
+                return
+            max_rate = float(parts[3]) if len(parts) > 3 and parts[3] else 0
+            self.add_subscriber(address, fmt, max_rate)
+            self.control_sock.sendto(f"SUBOK,{address[1]},{subscriber_ttl:g}".encode('utf-8'), addr)
+        elif command == 'ACK':
+            with self.lock:
+                subscriber = self.subscribers.get(address)
+                if subscriber is not None:
+                    subscriber['last_seen'] = time.monotonic()
+        elif command == 'UNSUB':
+            with self.lock:
+                if address in self.subscribers and not self.subscribers[address]['static']:
+                    del self.subscribers[address]
+                    print(f"[INFO] Sottoscrittore {address[0]}:{address[1]} rimosso")
+        else:
+            print(f"Comando di controllo sconosciuto da {addr}: {message}")
+
+    def expire_subscribers(self, now):
+        with self.lock:
+            for address, subscriber in list(self.subscribers.items()):
+                if not subscriber['static'] and now - subscriber['last_seen'] > subscriber_ttl:
+                    del self.subscribers[address]
+                    print(f"[INFO] Sottoscrittore {address[0]}:{address[1]} scaduto")
+
+    def publish(self, text, pos1, serialize):
+        """
+        Invia l'aggiornamento a tutti i sottoscrittori.
+        text: pacchetto testuale dello stream (None se non è cambiato nulla)
+        pos1: pacchetto POS1 (None se non ci sono cavalli)
+        serialize(kind): costruisce su richiesta il payload 'keyframe' (testo completo) o 'binary'
+        """
+        now = time.monotonic()
+        if now - self.last_sweep >= 1.0:
+            self.expire_subscribers(now)
+            self.last_sweep = now
+
+        payloads = {}
+        if text is not None:
+            payloads['text'] = text.encode('utf-8')
+        if pos1 is not None:
+            payloads['pos1'] = pos1.encode('utf-8')
+
+        def payload(kind):
+            if kind not in payloads:
+                payloads[kind] = serialize(kind)
+            return payloads[kind]
+
+        with self.lock:
+            subscribers = list(self.subscribers.values())
+
+        for subscriber in subscribers:
+            due = subscriber['last_sent'] is None or now - subscriber['last_sent'] >= subscriber['min_interval']
+            try:
+                if subscriber['format'] == 'binary':
+                    if not due:
+                        continue
+                    self.sock.sendto(payload('binary'), subscriber['address'])
+                else:
+                    if not due:
+                        # Un aggiornamento saltato invalida lo stream delta di questo sottoscrittore
+                        subscriber['needs_keyframe'] = True
+                        continue
+                    if subscriber['needs_keyframe']:
+                        data = payload('keyframe')
+                    elif text is not None:
+                        data = payloads['text']
+                    else:
+                        continue
+                    self.sock.sendto(data, subscriber['address'])
+                    subscriber['needs_keyframe'] = False
+                    if pos1 is not None:
+                        self.sock.sendto(payloads['pos1'], subscriber['address'])
+                subscriber['last_sent'] = now
+            except (OSError, OverflowError) as e:
+                # Un sottoscrittore non raggiungibile non deve bloccare gli altri
+                print(f"Errore nell'invio a {subscriber['address']}: {e}")
+
 # ==========================
 # Gestione del Server UDP
 # ==========================
@@ -220,10 +542,29 @@ class UDPServer:
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.horses = {}  # Dizionario per tenere traccia dei cavalli
         self.race_start_time = None
+        self.race_start_mono = None
+        self.recorder = None  # Archivio della gara in corso
+        self.latency = LatencyStats()
+        self.tracker_time_rejected = False  # Avviso sui timestamp del tracker già stampato
+        self.last_horse_sweep = time.monotonic()
+
+        # Timestamp di ricezione del kernel, per separare la coda della socket dall'elaborazione
+        self.kernel_timestamps = False
+        if SO_TIMESTAMPNS is not None:
+            try:
+                self.sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+                self.kernel_timestamps = True
+            except OSError:
+                pass
+
+        # Stato dello stream delta: ultima classifica trasmessa e numero di sequenza
+        self.stream_seq = 0
+        self.stream_order = []      # Ordine dei cavalli nell'ultimo pacchetto inviato
+        self.stream_fields = {}     # horse_id -> campi dell'ultima voce inviata
+        self.last_keyframe_time = None
 
-        # Socket per inviare i pacchetti della classifica
-        self.broadcast_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.broadcast_address = ('0.0.0.0', 4141)
+        # Pubblicazione della classifica verso i sottoscrittori
+        self.publisher = Publisher(self.listen_ip, control_port)
 
         try:
             self.sock.bind((self.listen_ip, self.listen_port))
@@ -233,19 +574,80 @@ class UDPServer:
             exit(1)
 
     def start(self):
+        self.publisher.start()
         thread = threading.Thread(target=self.listen)
         thread.daemon = True
         thread.start()
 
     def listen(self):
+        # Il timeout permette di segnare i cavalli senza segnale anche se non arrivano pacchetti
+        self.sock.settimeout(horse_sweep_interval)
         while True:
             try:
-                data, addr = self.sock.recvfrom(1024)  # Buffer size 1024 bytes
-                self.process_packet(data, addr)
+                try:
+                    data, addr, receipt = self.receive()
+                    self.process_packet(data, addr, receipt)
+                except socket.timeout:
+                    pass
+                if time.monotonic() - self.last_horse_sweep >= horse_sweep_interval:
+                    self.expire_horses()
             except Exception as e:
                 print(f"Errore nella ricezione dei dati: {e}")
 
-    def process_packet(self, data, addr):
+    def admit_horse(self, horse_id):
+        """
+        Controllo di ammissione di un nuovo horse_id: deve essere nel roster (se configurato)
+        e c'è posto solo entro max_horses. Solo un cavallo del roster può liberare il posto
+        del cavallo senza segnale da più tempo; senza roster un id sconosciuto viene rifiutato.
+        """
+        if roster is not None and horse_id not in roster:
+            print(f"[WARN] Cavallo {horse_id} non presente nel roster: ignorato")
+            return False
+        if len(self.horses) < max_horses:
+            return True
+        silent = [(data['last_fix_mono'], other_id) for other_id, data in self.horses.items() if data['no_signal']]
+        if roster is None or not silent:
+            print(f"[WARN] Classifica piena ({max_horses} cavalli): cavallo {horse_id} ignorato")
+            return False
+        evicted_id = min(silent)[1]
+        del self.horses[evicted_id]
+        print(f"[INFO] Cavallo {evicted_id} senza segnale rimosso per far posto al cavallo {horse_id}")
+        return True
+
+    def expire_horses(self):
+        """Segna "no signal" i cavalli senza fix da più di horse_ttl secondi, senza toglierli dalla classifica."""
+        now = time.monotonic()
+        self.last_horse_sweep = now
+        expired = False
+        for horse_id, horse in self.horses.items():
+            if not horse['no_signal'] and now - horse['last_fix_mono'] > horse_ttl:
+                horse['no_signal'] = True
+                expired = True
+                print(f"[INFO] Cavallo {horse_id}: nessun segnale da {horse_ttl:g}s")
+        if expired and self.race_started_event.is_set():
+            self.send_rankings()
+
+    def receive(self):
+        """
+        Riceve un datagramma e restituisce (data, addr, receipt), dove receipt contiene
+        l'istante di ricezione del kernel (se disponibile), l'orario e il tempo monotono di lettura.
+        """
+        kernel_time = None
+        if self.kernel_timestamps:
+            data, ancdata, flags, addr = self.sock.recvmsg(1024, socket.CMSG_SPACE(16))  # Buffer size 1024 bytes
+            mono = time.monotonic()
+            for level, kind, cmsg_data in ancdata:
+                if level == socket.SOL_SOCKET and kind == SO_TIMESTAMPNS and len(cmsg_data) >= 16:
+                    seconds, nanoseconds = struct.unpack('qq', cmsg_data[:16])
+                    kernel_time = seconds + nanoseconds / 1e9
+        else:
+            data, addr = self.sock.recvfrom(1024)  # Buffer size 1024 bytes
+            mono = time.monotonic()
+        return data, addr, {'kernel': kernel_time, 'wall': time.time(), 'mono': mono}
+
+    def process_packet(self, data, addr, receipt=None):
+        if receipt is None:
+            receipt = {'kernel': None, 'wall': time.time(), 'mono': time.monotonic()}
         data_str = data.decode('utf-8').strip()
         # print(data_str)
         if not self.race_started_event.is_set():
@@ -254,13 +656,30 @@ class UDPServer:
                 print("[INFO] Comando di avvio ricevuto. Inizio della gara!")
                 self.race_started_event.set()
                 self.race_start_time = time.time() # parte il timer
+                self.race_start_mono = receipt['mono']
+                self.latency = LatencyStats()  # Il report di fine gara riguarda solo questa gara
+                if race_archive_dir:
+                    recorder = RaceRecorder(os.path.join(race_archive_dir, time.strftime('%Y%m%d-%H%M%S')))
+                    try:
+                        recorder.start()
+                        self.recorder = recorder
+                    except Exception as e:
+                        # La gara prosegue senza archivio
+                        print(f"[WARN] Impossibile creare l'archivio della gara in {recorder.directory}: {e}")
+                        self.recorder = None
             return
         else:
             if "END" in data_str.upper():
                 print("[INFO] Comando di fine gara ricevuto. Fine della gara!")
+                self.latency.report()
                 self.horses = {}  # Resetta le informazioni dei cavalli
                 self.race_started_event.clear()
                 self.race_start_time = None
+                self.race_start_mono = None
+                if self.recorder is not None:
+                    self.recorder.close()
+                    print(f"[INFO] Gara archiviata in {self.recorder.directory}")
+                    self.recorder = None
                 return
             # Se la gara è iniziata, processa i pacchetti GPS
             try:
@@ -277,6 +696,23 @@ class UDPServer:
                 CavLati = float(parts[2].strip())
                 CavLong = float(parts[3].strip())
                 horseSpeed = float(parts[6].strip()) * 3.6
+                tracker_time = parse_tracker_timestamp(parts[tracker_timestamp_field].strip())
+                if not horse_id or not (-90 <= CavLati <= 90 and -180 <= CavLong <= 180 and math.isfinite(horseSpeed)):
+                    print(f"Dati non validi ricevuti: {data_str}")
+                    return
+                # Un timestamp lontano dalla ricezione non è un orario del tracker (campo diverso o
+                # orologio non sincronizzato): si usa l'istante di ricezione
+                if tracker_time is not None and abs(tracker_time - receipt['wall']) > tracker_timestamp_tolerance:
+                    if not self.tracker_time_rejected:
+                        print(f"[WARN] Timestamp del tracker non plausibile ({parts[tracker_timestamp_field].strip()}): "
+                              f"uso l'istante di ricezione")
+                        self.tracker_time_rejected = True
+                    tracker_time = None
+
+                # Ammissione solo dopo aver validato tutto il fix: un pacchetto malformato
+                # non deve poter togliere un cavallo dalla classifica
+                if horse_id not in self.horses and not self.admit_horse(horse_id):
+                    return
 
                 # Converti le coordinate GPS in coordinate locali
                 xCav, yCav = convert_gps_to_local(
@@ -312,9 +748,26 @@ class UDPServer:
                         'last_segment': None,
                         'metriCorsiaDelCavallo': 0.0,
                         'horseSpeed': 0.0,
-                        'start_time': time.time()
+                        'fix_time': None,
+                        'start_distance': None,     # Distanza al primo fix: origine dei metri di gara
+                        'race_meters': 0.0,         # Metri percorsi dalla partenza
+                        'origin_time': None,        # Istante del primo fix: origine dei tempi di gara
+                        'sectional_time': None,     # Istante del fix a cui si riferisce race_meters
+                        'next_marker': min(sectional_interval, total_race_meters),
+                        'last_marker_time': None,   # Istante dell'ultimo marker superato (o del primo fix)
+                        'splits': [],               # Tempi parziali ogni sectional_interval metri
+                        'pace': None,               # Media esponenziale del passo (m/s)
+                        'finish_time': None,        # Tempo finale (s dalla partenza), al passaggio del traguardo
+                        'projected_finish': None,   # Tempo finale previsto (s dalla partenza)
+                        'last_fix_mono': receipt['mono'],
+                        'no_signal': False
                     })
 
+                    if horse['no_signal']:
+                        print(f"[INFO] Cavallo {horse_id}: segnale ritrovato")
+                        horse['no_signal'] = False
+                    horse['last_fix_mono'] = receipt['mono']
+
                     # Verifica se il cavallo ha completato un giro
                     if total_distance < horse['prev_distance'] and (horse['prev_distance'] - total_distance) > (self.total_track_length / 2):
                         horse['laps_completed'] += 1
@@ -336,53 +789,213 @@ class UDPServer:
                     horse['x'] = xCav
                     horse['y'] = yCav # PARAMETRO NUOVO YYYYYY
                     horse['metriCorsiaDelCavallo'] = metriCorsiaDelCavallo  # PARAMETRO NUOVO CORSIA CAVALLO
+                    # Istante del fix: timestamp del tracker se presente, altrimenti la ricezione
+                    horse['fix_time'] = tracker_time if tracker_time is not None else (receipt['kernel'] or receipt['wall'])
+                    self.update_sectionals(horse_id, horse)
                     self.horses[horse_id] = horse
 
+                    if self.recorder is not None:
+                        self.recorder.record(
+                            receipt['mono'] - self.race_start_mono, horse_id, xCav, yCav, total_distance_with_laps,
+                            metriCorsiaDelCavallo, horseSpeed, horse['laps_completed']
+                        )
+
                     # Aggiorna, stampa e invia la classifica
                     self.send_rankings()
+                    self.latency.add(receipt, tracker_time, time.monotonic())
 
             except Exception as e:
                 print(f"Errore nell'elaborazione dei dati da {addr}: {data_str}\n{e}")
 
-    def send_rankings(self):
-        # Ordina i cavalli per distanza percorsa in ordine decrescente
-        sorted_horses = sorted(self.horses.items(), key=lambda x: x[1]['distance'], reverse=True)
+    def update_sectionals(self, horse_id, horse):
+        """
+        Aggiorna in O(1) i tempi parziali e il tempo finale previsto del cavallo.
+        Il passaggio di un marker è rilevato confrontando i metri di gara di due fix consecutivi
+        e il suo istante è interpolato linearmente tra i due fix.
+        Tutti i tempi sono nella base del fix (timestamp del tracker o ricezione), con origine
+        nel primo fix del cavallo, che è anche l'origine dei metri di gara.
+        """
+        fix_time = horse['fix_time']
+        if horse['start_distance'] is None:
+            horse['start_distance'] = horse['distance']
+            horse['origin_time'] = fix_time
+            horse['last_marker_time'] = fix_time
+            horse['sectional_time'] = fix_time
+            return
 
-        # Costruisci il pacchetto da inviare con il formato richiesto
-        packet = "CLASSIFICA"
+        # Fix fuori ordine o duplicato: non altera la coppia (tempo, metri) usata per interpolare
+        prev_time = horse['sectional_time']
+        if fix_time <= prev_time:
+            return
+        prev_meters = horse['race_meters']
+        meters = horse['distance'] - horse['start_distance']
+        horse['race_meters'] = meters
+        horse['sectional_time'] = fix_time
+        dt = fix_time - prev_time
+        origin = horse['origin_time']
+
+        # Marker superati tra il fix precedente e questo (più di uno se il tracker è lento)
+        while horse['finish_time'] is None and meters >= horse['next_marker']:
+            marker = horse['next_marker']
+            fraction = (marker - prev_meters) / (meters - prev_meters) if meters > prev_meters else 1.0
+            crossing_time = prev_time + max(0.0, min(1.0, fraction)) * dt
+            split = crossing_time - horse['last_marker_time']
+            horse['splits'].append(split)
+            horse['last_marker_time'] = crossing_time
+            print(f"[PARZIALE] Cavallo {horse_id}: {marker} m in {format_race_time(crossing_time - origin)} (parziale {split:.2f}s)")
+            if marker >= total_race_meters:
+                horse['finish_time'] = crossing_time - origin
+                horse['projected_finish'] = horse['finish_time']
+            else:
+                horse['next_marker'] = min(marker + sectional_interval, total_race_meters)
+
+        # Passo recente: media esponenziale pesata sul tempo, indipendente dalla frequenza del tracker
+        velocity = (meters - prev_meters) / dt
+        if horse['pace'] is None:
+            horse['pace'] = velocity
+        else:
+            horse['pace'] += (1 - math.exp(-dt / pace_time_constant)) * (velocity - horse['pace'])
+
+        if horse['finish_time'] is None:
+            if horse['pace'] > 1.0:
+                horse['projected_finish'] = (fix_time - origin) + (total_race_meters - meters) / horse['pace']
+            else:
+                horse['projected_finish'] = None
+
+    def build_entries(self, sorted_horses):
+        """
+        Costruisce le voci della classifica:
+        (horse_id, gap o None per l'ultimo, metri al traguardo, corsia, velocità o None se senza segnale,
+        tempo trascorso, ultimo parziale o None, tempo finale previsto o None).
+        """
+        # Tempo trascorso dal comando di START, uguale per tutti i cavalli
+        elapsed_time = time.monotonic() - self.race_start_mono
+        entries = []
         for idx, (horse_id, horse_data) in enumerate(sorted_horses):
             distance = horse_data['distance']
-            meters_covered = horse_data['meters_covered']
-            y_coordinate = horse_data['metriCorsiaDelCavallo']
-            horseSpeed = horse_data['horseSpeed']
-            
-            elapsed_time = time.time() - horse_data['start_time']
-            if elapsed_time >= 60:
-                minutes = int(elapsed_time) // 60
-                seconds = int(elapsed_time) % 60
-                elapsed_time_formatted = f"{minutes}m {seconds}s"
-            else:
-                elapsed_time_formatted = f"{int(elapsed_time)}s"
-            
             if idx < len(sorted_horses) - 1:
-                next_distance = sorted_horses[idx + 1][1]['distance']
-                gap = distance - next_distance
-                packet += f",({horse_id},{gap:.2f},{total_race_meters - meters_covered},{y_coordinate:.2f},{horseSpeed:.2f},{elapsed_time_formatted})"
+                gap = distance - sorted_horses[idx + 1][1]['distance']
             else:
-                packet += f",({horse_id},last one,{total_race_meters - meters_covered},{y_coordinate:.2f},{horseSpeed:.2f},{elapsed_time_formatted})"
-        print(packet)
+                gap = None
+            entries.append((
+                horse_id,
+                gap,
+                total_race_meters - horse_data['meters_covered'],
+                horse_data['metriCorsiaDelCavallo'],
+                None if horse_data['no_signal'] else horse_data['horseSpeed'],
+                elapsed_time,
+                horse_data['splits'][-1] if horse_data['splits'] else None,
+                horse_data['projected_finish']
+            ))
+        return entries
+
+    def format_entry(self, entry):
+        """Formatta una voce della classifica come tupla di stringhe per i pacchetti testuali."""
+        horse_id, gap, meters_to_finish, y_coordinate, horseSpeed, elapsed_time, last_split, projected_finish = entry
+        if elapsed_time >= 60:
+            minutes = int(elapsed_time) // 60
+            seconds = int(elapsed_time) % 60
+            elapsed_time_formatted = f"{minutes}m {seconds}s"
+        else:
+            elapsed_time_formatted = f"{int(elapsed_time)}s"
+        gap_formatted = "last one" if gap is None else f"{gap:.2f}"
+        speed_formatted = "no signal" if horseSpeed is None else f"{horseSpeed:.2f}"
+        split_formatted = "-" if last_split is None else f"{last_split:.2f}"
+        projected_formatted = "-" if projected_finish is None else format_race_time(projected_finish)
+        return (horse_id, gap_formatted, f"{meters_to_finish}", f"{y_coordinate:.2f}", speed_formatted, elapsed_time_formatted,
+                split_formatted, projected_formatted)
 
-        # Invia il pacchetto UDP all'indirizzo specificato
-        self.broadcast_sock.sendto(packet.encode('utf-8'), self.broadcast_address)
-        
-        # Subito dopo, invia il pacchetto TEL
+    def build_stream_packet(self, entries):
+        """
+        Modalità 'delta': restituisce un KEYFRAME (classifica completa) se è scaduto l'intervallo
+        o se l'insieme dei cavalli è cambiato, altrimenti un DELTA con i soli campi modificati
+        e le posizioni cambiate. Restituisce None se non è cambiato nulla.
+        """
+        now = time.monotonic()
+        order = [entry[0] for entry in entries]
+        fields = {entry[0]: entry[1:] for entry in entries}
+
+        keyframe_due = (
+            self.last_keyframe_time is None
+            or (now - self.last_keyframe_time) * 1000 >= keyframe_interval_ms
+            or set(order) != set(self.stream_order)
+        )
+
+        if keyframe_due:
+            self.stream_seq += 1
+            self.last_keyframe_time = now
+            packet = f"KEYFRAME,{self.stream_seq}"
+            for entry in entries:
+                packet += f",({','.join(entry)})"
+        else:
+            # Posizioni in cui è cambiato il cavallo (1 = primo)
+            swaps = [f"{idx + 1}:{horse_id}" for idx, horse_id in enumerate(order) if self.stream_order[idx] != horse_id]
+            # Campi modificati per ciascun cavallo
+            changes = []
+            for horse_id in order:
+                old_fields = self.stream_fields[horse_id]
+                changed = [f"{code}={value}" for code, value, old_value in zip(delta_field_codes, fields[horse_id], old_fields) if value != old_value]
+                if changed:
+                    changes.append(f"({horse_id},{','.join(changed)})")
+            if not swaps and not changes:
+                return None
+            self.stream_seq += 1
+            packet = f"DELTA,{self.stream_seq}"
+            if swaps:
+                packet += f",[{';'.join(swaps)}]"
+            for change in changes:
+                packet += f",{change}"
+
+        self.stream_order = order
+        self.stream_fields = fields
+        return packet
+
+    def send_rankings(self):
+        # Ordina i cavalli per distanza percorsa in ordine decrescente
+        sorted_horses = sorted(self.horses.items(), key=lambda x: x[1]['distance'], reverse=True)
+        entries = self.build_entries(sorted_horses)
+        text_entries = [self.format_entry(entry) for entry in entries]
+
+        # Costruisci il pacchetto da inviare con il formato richiesto
+        if output_mode == 'delta':
+            packet = self.build_stream_packet(text_entries)
+        else:
+            self.stream_seq += 1
+            packet = "CLASSIFICA"
+            for entry in text_entries:
+                packet += f",({','.join(entry)})"
+
+        # Età del fix più recente e di quello più vecchio tra i cavalli con segnale
+        now = time.time()
+        fix_ages = [now - horse_data['fix_time'] for horse_id, horse_data in sorted_horses if not horse_data['no_signal']]
+        freshest_age = min(fix_ages) if fix_ages else 0.0
+        stalest_age = max(fix_ages) if fix_ages else 0.0
+        age_field = f",AGE={freshest_age * 1000:.0f}/{stalest_age * 1000:.0f}"
+        if packet is not None:
+            packet += age_field
+            print(packet)
+
+        # Subito dopo il pacchetto della classifica va il pacchetto TEL con la posizione del primo
+        leader_x = leader_y = 0.0
+        tel_packet = None
         if len(sorted_horses) > 0:
             leader_id, leader_data = sorted_horses[0]
             leader_x = leader_data['x']
             leader_y = leader_data['y']
             tel_packet = f"POS1,{leader_x:.2f},{leader_y:.2f}"
-            self.broadcast_sock.sendto(tel_packet.encode('utf-8'), self.broadcast_address)
 
+        def serialize(kind):
+            if kind == 'binary':
+                return encode_binary_leaderboard(self.stream_seq, entries, leader_x, leader_y, freshest_age, stalest_age)
+            # Classifica completa per i sottoscrittori che devono risincronizzarsi
+            keyframe = f"KEYFRAME,{self.stream_seq}" if output_mode == 'delta' else "CLASSIFICA"
+            for entry in text_entries:
+                keyframe += f",({','.join(entry)})"
+            keyframe += age_field
+            return keyframe.encode('utf-8')
+
+        # Invia i pacchetti UDP ai sottoscrittori
+        self.publisher.publish(packet, tel_packet, serialize)
 
         # Stampa la classifica per debug con il gap tra i cavalli e i metri percorsi
         print("\nClassifica attuale:")
@@ -433,10 +1046,14 @@ def main():
     waiting_thread.daemon = True
     waiting_thread.start()
 
-    # Mantieni il thread principale in esecuzione
+    # Mantieni il thread principale in esecuzione, stampando periodicamente il report di latenza
     try:
+        last_report = time.monotonic()
         while True:
             time.sleep(1)
+            if race_started_event.is_set() and time.monotonic() - last_report >= latency_report_interval:
+                udp_server.latency.report()
+                last_report = time.monotonic()
     except KeyboardInterrupt:
         print("Server UDP terminato.")
 